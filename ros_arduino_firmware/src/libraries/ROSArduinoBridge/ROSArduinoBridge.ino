@@ -155,6 +155,9 @@ int runCommand() {
   char *p = argv1;
   char *str;
   int pid_args[4];
+  int nvalues = 0;
+  long counts[2];
+  uint8_t checksum;
   arg1 = atoi(argv1);
   arg2 = atoi(argv2);
   
@@ -185,6 +188,25 @@ int runCommand() {
   case PING:
     Serial.println(Ping(arg1));
     break;
+  case POLL_SENSORS:
+    /* Reply on one line with the encoder counts (if arg2 is non-zero)
+       followed by each analog pin whose bit is set in arg1 */
+#ifdef USE_BASE
+    if (arg2 != 0) {
+      Serial.print(readEncoder(LEFT));
+      Serial.print(" ");
+      Serial.print(readEncoder(RIGHT));
+      nvalues = 2;
+    }
+#endif
+    for (i = 0; i < 16; i++) {
+      if ((arg1 >> i) & 1) {
+        if (nvalues++ > 0) Serial.print(" ");
+        Serial.print(analogRead(i));
+      }
+    }
+    Serial.println();
+    break;
 #ifdef USE_SERVOS
   case SERVO_WRITE:
     servos[arg1].setTargetPosition(arg2);
@@ -201,6 +223,19 @@ int runCommand() {
     Serial.print(" ");
     Serial.println(readEncoder(RIGHT));
     break;
+  case READ_ENCODERS_BIN:
+    /* The same counts as READ_ENCODERS sent as two little-endian 32-bit
+       integers between a marker byte and the XOR of their bytes, followed
+       by a line ending so the host can check framing */
+    counts[0] = readEncoder(LEFT);
+    counts[1] = readEncoder(RIGHT);
+    checksum = 0;
+    for (i = 0; i < sizeof(counts); i++) checksum ^= ((uint8_t *)counts)[i];
+    Serial.write(ENCODER_FRAME_MARKER);
+    Serial.write((uint8_t *)counts, sizeof(counts));
+    Serial.write(checksum);
+    Serial.println();
+    break;
    case RESET_ENCODERS:
     resetEncoders();
     resetPID();
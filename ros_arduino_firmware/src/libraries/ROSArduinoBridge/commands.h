@@ -10,8 +10,10 @@
 #define PIN_MODE       'c'
 #define DIGITAL_READ   'd'
 #define READ_ENCODERS  'e'
+#define READ_ENCODERS_BIN 'E'
 #define MOTOR_SPEEDS   'm'
 #define PING           'p'
+#define POLL_SENSORS   'q'
 #define RESET_ENCODERS 'r'
 #define SERVO_WRITE    's'
 #define SERVO_READ     't'
@@ -21,6 +23,10 @@
 #define LEFT            0
 #define RIGHT           1
 
+/* First byte of the READ_ENCODERS_BIN reply.  It never appears in a text
+   reply, so a line of text cannot be mistaken for a frame. */
+#define ENCODER_FRAME_MARKER 0xFE
+
 #endif
 
 
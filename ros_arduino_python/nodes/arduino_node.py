@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """
     A ROS Node for the Arduino microcontroller
@@ -25,8 +25,8 @@ from ros_arduino_python.arduino_sensors import *
 from ros_arduino_msgs.srv import *
 from ros_arduino_python.base_controller import BaseController
 from geometry_msgs.msg import Twist
-import os, time
-import thread
+import os, sys, time
+import threading
 from serial.serialutil import SerialException
 
 class ArduinoROS():
@@ -36,9 +36,6 @@ class ArduinoROS():
         # Get the actual node name in case it is set in the launch file
         self.name = rospy.get_name()
 
-        # Cleanup when termniating the node
-        rospy.on_shutdown(self.shutdown)
-
         self.port = rospy.get_param("~port", "/dev/ttyACM0")
         self.baud = int(rospy.get_param("~baud", 57600))
         self.timeout = rospy.get_param("~timeout", 0.5)
@@ -93,20 +90,29 @@ class ArduinoROS():
         # Initialize the controlller
         self.controller = Arduino(self.port, self.baud, self.timeout, self.motors_reversed)
 
-        # Make the connection
-        self.controller.connect()
+        # Make the connection, stopping the motors and closing the port if it fails
+        try:
+            self.controller.connect()
+        except SerialException:
+            if self.controller.is_open():
+                self.controller.stop()
+            self.controller.close()
+            raise
+
+        # Cleanup when termniating the node
+        rospy.on_shutdown(self.shutdown)
 
         rospy.loginfo("Connected to Arduino on port " + self.port + " at " + str(self.baud) + " baud")
 
         # Reserve a thread lock
-        mutex = thread.allocate_lock()
+        mutex = threading.Lock()
 
         # Initialize any sensors
         self.mySensors = list()
 
         sensor_params = rospy.get_param("~sensors", dict({}))
 
-        for name, params in sensor_params.iteritems():
+        for name, params in sensor_params.items():
             # Set the direction to input if not specified
             try:
                 params['direction']
@@ -226,4 +232,4 @@ if __name__ == '__main__':
         myArduino = ArduinoROS()
     except SerialException:
         rospy.logerr("Serial exception trying to open port.")
-        os._exit(0)
+        sys.exit(1)
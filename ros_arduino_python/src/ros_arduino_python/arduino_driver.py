@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """
     A Python driver for the Arduino microcontroller running the
@@ -21,10 +21,14 @@
 
 """
 
-import thread
+import threading
+import queue
+from collections import deque
 from math import pi as PI, degrees, radians
 import os
+import selectors
 import time
+import struct
 import sys, traceback
 from serial.serialutil import SerialException
 from serial import Serial
@@ -32,6 +36,48 @@ from serial import Serial
 SERVO_MAX = 180
 SERVO_MIN = 0
 
+# Command templates matching commands.h in the firmware.  Each one already ends
+# with the carriage return the firmware waits for, so a command costs a single
+# format operation.
+ANALOG_READ    = b'a %d\r'
+GET_BAUDRATE   = b'b\r'
+PIN_MODE       = b'c %d %d\r'
+DIGITAL_READ   = b'd %d\r'
+READ_ENCODERS  = b'e\r'
+READ_ENCODERS_BIN = b'E\r'
+MOTOR_SPEEDS   = b'm %d %d\r'
+PING           = b'p %d\r'
+POLL_SENSORS   = b'q %d %d\r'
+RESET_ENCODERS = b'r\r'
+SERVO_WRITE    = b's %d %d\r'
+SERVO_READ     = b't %d\r'
+UPDATE_PID     = b'u %d:%d:%d:%d\r'
+DIGITAL_WRITE  = b'w %d %d\r'
+ANALOG_WRITE   = b'x %d %d\r'
+
+# Reply to READ_ENCODERS_BIN: a marker byte, the left and right counts as
+# little-endian 32-bit integers, and the XOR of the bytes of the counts
+ENCODER_FRAME = struct.Struct('<B2lB')
+ENCODER_FRAME_MARKER = 0xFE
+
+class PendingReply:
+    ''' A command written to the Arduino and the slot its reply is delivered to.
+        size is the length of a binary reply, or 0 for a line of text.
+        check_ack marks a command nobody waits for: the reader thread only
+        checks that its reply is OK.
+    '''
+    def __init__(self, cmd, size=0, check_ack=False):
+        self.cmd = cmd
+        self.size = size
+        self.check_ack = check_ack
+        self.value = None
+        self.event = threading.Event()
+
+    def done(self):
+        ''' True once the reply has arrived or the command has been dropped.
+        '''
+        return self.event.is_set()
+
 class Arduino:
     ''' Configuration Parameters
     '''
@@ -41,17 +87,74 @@ class Arduino:
     def __init__(self, port="/dev/ttyUSB0", baudrate=57600, timeout=0.5, motors_reversed=False):
 
         self.PID_RATE = 30 # Do not change this!  It is a fixed property of the Arduino PID controller.
-        self.PID_INTERVAL = 1000 / 30
+        self.PID_INTERVAL = 1000 // 30
 
         self.port = port
         self.baudrate = baudrate
         self.timeout = timeout
         self.encoder_count = 0
         self.writeTimeout = timeout
-        self.interCharTimeout = timeout / 30.
+        # Serial reads return after this long so the reader never sits on a
+        # half-received reply for the full command timeout.
+        self.interCharTimeout = 0.01
         self.motors_reversed = motors_reversed
-        # Keep things thread safe
-        self.mutex = thread.allocate_lock()
+
+        # Encoder ticks per PID interval for a wheel speed of 1 m/s.  The wheel
+        # geometry is assigned by the caller, so this is computed on first use.
+        self.ticks_per_mps = None
+
+        # The last motor speeds sent, so unchanged speeds are not sent again.
+        # The firmware stops the motors after AUTO_STOP_INTERVAL (2 seconds)
+        # without a motor command, so speeds are resent after drive_refresh seconds.
+        # Changes of up to drive_deadband ticks per PID interval are also skipped.
+        self.last_drive = None
+        self.last_drive_time = 0
+        self.drive_refresh = 1.0
+        self.drive_deadband = 0
+        self.last_drive_errors = 0
+
+        # Commands sent without waiting whose reply was not OK
+        self.ack_errors = 0
+
+        # Callers queue commands here and a single writer thread sends them.
+        # While the port is still sending, the writer waits this long for more
+        # commands to go out in the same write.
+        self.commands = queue.Queue()
+        self.tx_coalesce = 0.001
+
+        # Commands written to the Arduino that are still waiting for a reply.
+        # The firmware answers in order so replies are matched first in, first out.
+        # The writer thread appends, taking back any it fails to write, and the
+        # reader thread pops as replies arrive.
+        # resync() empties it from whichever thread calls it.
+        self.pending = deque()
+
+        # Guards pending and rx_generation between the writer, the reader and
+        # resync(), so a command is never written or matched while the queue is reset
+        self.mutex = threading.Lock()
+
+        # The AVR's serial receive buffer holds 64 bytes and anything beyond that
+        # is dropped, so limit the bytes of commands still waiting for a reply.
+        self.max_in_flight = 48
+        self.in_flight = 0
+        self.in_flight_changed = threading.Condition()
+
+        # The threads that write commands to and read replies from the serial port
+        self.writer = None
+        self.reader = None
+        self.reading = False
+
+        # Bytes received from the Arduino that do not yet form a complete line.
+        # Only the reader thread touches the buffer: resync() bumps rx_generation
+        # and the reader empties it when it sees the change.
+        self.rxbuf = bytearray()
+        self.rx_generation = 0
+        self.rx_seen = 0
+
+        # The port's file descriptor, where the platform provides one, and a pipe
+        # that wakes the reader thread when it is time to stop
+        self.fd = None
+        self.wakeup = None
 
         # An array to cache analog sensor readings
         self.analog_sensor_cache = [None] * self.N_ANALOG_PORTS
@@ -60,281 +163,737 @@ class Arduino:
         self.digital_sensor_cache = [None] * self.N_DIGITAL_PORTS
 
     def connect(self):
+        ''' Open the serial port and check that the firmware answers at the expected
+            baud rate.  Raises SerialException if it does not, leaving the caller to
+            stop the motors and close the port.
+        '''
         try:
-            print "Connecting to Arduino on port", self.port, "..."
-            self.port = Serial(port=self.port, baudrate=self.baudrate, timeout=self.timeout, writeTimeout=self.writeTimeout)
-            # The next line is necessary to give the firmware time to wake up.
-            time.sleep(1)
+            print("Connecting to Arduino on port", self.port, "...")
+            self.port = Serial(port=self.port, baudrate=self.baudrate, timeout=self.interCharTimeout, inter_byte_timeout=self.interCharTimeout, writeTimeout=self.writeTimeout)
+            self.set_low_latency()
+            self.port.reset_input_buffer()
+            self.port.reset_output_buffer()
+            self.start_threads()
+            # Opening the port usually resets the Arduino.  Rather than sleeping for
+            # a fixed time, keep asking for the baud rate until the firmware wakes up.
+            deadline = time.monotonic() + 3
             test = self.get_baud()
-            if test != self.baudrate:
-                time.sleep(1)
+            while test != self.baudrate and time.monotonic() < deadline:
                 test = self.get_baud()
-                if test != self.baudrate:
-                    raise SerialException
-            print "Connected at", self.baudrate
-            print "Arduino is ready."
+            if test != self.baudrate:
+                raise SerialException
+            print("Connected at", self.baudrate)
+            print("Arduino is ready.")
 
         except SerialException:
-            print "Serial Exception:"
-            print sys.exc_info()
-            print "Traceback follows:"
+            print("Serial Exception:")
+            print(sys.exc_info())
+            print("Traceback follows:")
             traceback.print_exc(file=sys.stdout)
-            print "Cannot connect to Arduino!"
-            os._exit(1)
+            print("Cannot connect to Arduino!")
+            raise SerialException("Cannot connect to Arduino")
 
     def open(self):
         ''' Open the serial port.
         '''
         self.port.open()
+        self.start_threads()
 
     def close(self):
         ''' Close the serial port.
         '''
-        self.port.close()
+        self.stop_threads()
+        if isinstance(self.port, Serial):
+            self.port.close()
 
-    def send(self, cmd):
-        ''' This command should not be used on its own: it is called by the execute commands
-            below in a thread safe manner.
+    def is_open(self):
+        ''' True once connect() has opened the serial port.
         '''
-        self.port.write(cmd + '\r')
+        return isinstance(self.port, Serial) and self.port.is_open
 
-    def recv(self, timeout=0.5):
-        timeout = min(timeout, self.timeout)
-        ''' This command should not be used on its own: it is called by the execute commands
-            below in a thread safe manner.  Note: we use read() instead of readline() since
-            readline() tends to return garbage characters from the Arduino
+    def set_low_latency(self):
+        ''' FTDI USB serial adapters hold partial packets for 16 ms by default,
+            which adds that much to every command round trip.  Ask the driver
+            to flush them right away.  Ports that do not support it are left as is.
         '''
-        c = ''
-        value = ''
-        attempts = 0
-        while c != '\r':
-            c = self.port.read(1)
-            value += c
-            attempts += 1
-            if attempts * self.interCharTimeout > timeout:
-                return None
+        if os.name != "posix" or not self.port.port.startswith('/dev/ttyUSB'):
+            return
+        try:
+            self.port.set_low_latency_mode(True)
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+
+    def start_threads(self):
+        ''' Start the thread that writes queued commands to the Arduino and the
+            thread that matches its replies to the commands waiting for them.
+        '''
+        if self.reader is not None and self.reader.is_alive():
+            return
+        try:
+            self.fd = self.port.fileno()
+        except:
+            self.fd = None
+        if self.fd is not None:
+            self.wakeup = os.pipe()
+        self.reading = True
+        self.writer = threading.Thread(target=self.write_commands)
+        self.writer.daemon = True
+        self.writer.start()
+        self.reader = threading.Thread(target=self.read_replies)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def stop_threads(self):
+        ''' Stop the writer and reader threads and release any commands still
+            waiting for a reply.
+        '''
+        self.reading = False
+        self.in_flight_changed.acquire()
+        try:
+            self.in_flight_changed.notify_all()
+        finally:
+            self.in_flight_changed.release()
+        if self.wakeup is not None:
+            os.write(self.wakeup[1], b'x')
+        if self.writer is not None:
+            self.commands.put(None)
+            self.writer.join(self.timeout * 2)
+            self.writer = None
+        if self.reader is not None:
+            self.reader.join(self.timeout * 2)
+            alive = self.reader.is_alive()
+            self.reader = None
+        else:
+            alive = False
+        # Only close the pipe once the reader can no longer be selecting on it
+        if self.wakeup is not None and not alive:
+            os.close(self.wakeup[0])
+            os.close(self.wakeup[1])
+            self.wakeup = None
+        self.resync()
+
+    def write_commands(self):
+        ''' Runs in the writer thread.  All commands waiting in the queue are added
+            to the pending replies and written to the port in one call.
+        '''
+        running = True
+        while running:
+            batch = self.commands.get()
+            if batch is None:
+                break
+            replies, running = self.take_commands(list(batch), True)
+
+            # The port is still busy with the last write, so more commands can
+            # join this one without delaying it.
+            try:
+                busy = self.port.out_waiting > 0
+            except:
+                busy = False
+            if busy and running:
+                time.sleep(self.tx_coalesce)
+                replies, running = self.take_commands(replies, running)
+
+            while replies:
+                n = self.reserve_in_flight(replies)
+                self.write_replies(replies[:n])
+                replies = replies[n:]
+
+    def reserve_in_flight(self, replies):
+        ''' Wait until the first of replies fits in the Arduino's receive buffer
+            and reserve room for as many of them as fit.  Returns how many.
+        '''
+        self.in_flight_changed.acquire()
+        try:
+            while self.reading and self.in_flight > 0 and self.in_flight + len(replies[0].cmd) > self.max_in_flight:
+                self.in_flight_changed.wait(self.timeout)
+
+            n = 1
+            size = len(replies[0].cmd)
+            while n < len(replies) and self.in_flight + size + len(replies[n].cmd) <= self.max_in_flight:
+                size += len(replies[n].cmd)
+                n += 1
+            self.in_flight += size
+        finally:
+            self.in_flight_changed.release()
+
+        return n
+
+    def release_in_flight(self, size):
+        ''' Return the receive buffer space of an answered command to the writer.
+        '''
+        self.in_flight_changed.acquire()
+        try:
+            self.in_flight = max(0, self.in_flight - size)
+            self.in_flight_changed.notify()
+        finally:
+            self.in_flight_changed.release()
+
+    def write_replies(self, replies):
+        ''' Add the replies to the pending queue and write their commands to the
+            port in one call.
+        '''
+        self.mutex.acquire()
+        try:
+            self.pending.extend(replies)
+            try:
+                self.port.write(b''.join([reply.cmd for reply in replies]))
+            except:
+                print("Exception writing commands:", b' '.join([reply.cmd.strip() for reply in replies]).decode('ascii'))
+                for reply in replies:
+                    try:
+                        self.pending.remove(reply)
+                    except ValueError:
+                        pass
+                    self.release_in_flight(len(reply.cmd))
+                    reply.event.set()
+        finally:
+            self.mutex.release()
 
-        value = value.strip('\r')
+    def take_commands(self, replies, running):
+        ''' Add every batch already waiting in the command queue to replies without
+            blocking.  Returns the replies and False if the writer was asked to stop.
+        '''
+        while running:
+            try:
+                batch = self.commands.get_nowait()
+            except queue.Empty:
+                break
+            if batch is None:
+                running = False
+            else:
+                replies.extend(batch)
+
+        return replies, running
+
+    def read_replies(self):
+        ''' Runs in the reader thread.  The firmware answers commands strictly in
+            the order it receives them, so each complete reply is handed to the
+            oldest command still waiting for one.
+        '''
+        selector = None
+        if self.fd is not None:
+            selector = selectors.DefaultSelector()
+            selector.register(self.fd, selectors.EVENT_READ)
+            selector.register(self.wakeup[0], selectors.EVENT_READ)
 
-        return value
+        try:
+            self.handle_replies(selector)
+        finally:
+            if selector is not None:
+                selector.close()
 
-    def recv_ack(self):
-        ''' This command should not be used on its own: it is called by the execute commands
-            below in a thread safe manner.
+    def handle_replies(self, selector):
+        ''' Deliver replies until the reader is stopped.
         '''
-        ack = self.recv(self.timeout)
-        return ack == 'OK'
+        while self.reading:
+            self.sync_rxbuf()
+
+            try:
+                value = self.read_reply(selector)
+            except:
+                if self.reading:
+                    print("Exception reading from the Arduino")
+                    time.sleep(self.timeout)
+                continue
+
+            if value is None:
+                continue
+
+            # A reply read across a resync belongs to a dropped command
+            self.mutex.acquire()
+            try:
+                if self.rx_seen != self.rx_generation:
+                    continue
+                try:
+                    reply = self.pending.popleft()
+                except IndexError:
+                    continue
+            finally:
+                self.mutex.release()
+
+            self.release_in_flight(len(reply.cmd))
+
+            reply.value = value
+            reply.event.set()
+
+            # Nobody waits on a check_ack command, so a reply other than OK
+            # most likely means its own reply was lost and this one belongs to
+            # a later command.  Start over rather than shift every reply by one.
+            if reply.check_ack and value != 'OK':
+                self.ack_errors += 1
+                self.resync()
+
+    def read_reply(self, selector=None):
+        ''' Return the next reply received from the Arduino, or None if no complete
+            reply is available yet.  Everything already waiting on the port is read
+            in one call instead of byte by byte.  With a selector on the port's file
+            descriptor the bytes are read straight from it rather than through
+            pyserial's read loop, and the wait also ends when stop_threads() writes
+            to the wakeup pipe.
+        '''
+        value = self.split_reply()
+        if value is None:
+            if selector is None:
+                n = self.port.in_waiting
+                data = self.port.read(n if n else 1)
+                self.sync_rxbuf()
+                self.rxbuf += data
+            else:
+                for key, events in selector.select(self.timeout):
+                    if key.fd != self.fd:
+                        continue
+                    data = os.read(self.fd, 4096)
+                    if not data:
+                        raise SerialException("Arduino port is ready to read but returned no data")
+                    self.sync_rxbuf()
+                    self.rxbuf += data
+            value = self.split_reply()
 
-    def recv_int(self):
-        ''' This command should not be used on its own: it is called by the execute commands
-            below in a thread safe manner.
+        return value
+
+    def sync_rxbuf(self):
+        ''' Runs in the reader thread.  Empty the receive buffer if resync() has
+            been called since the last check, since what it holds is stale.
+        '''
+        generation = self.rx_generation
+        if generation != self.rx_seen:
+            self.rx_seen = generation
+            del self.rxbuf[:]
+
+    def split_reply(self):
+        ''' Remove the next complete reply from the receive buffer and return it.
+            A command expecting a binary frame gets its raw bytes, provided they are
+            followed by the line ending; anything else is taken as a line of text
+            and returned as a str without its line ending.
         '''
-        value = self.recv(self.timeout)
         try:
-            return int(value)
-        except:
+            size = self.pending[0].size
+        except IndexError:
+            size = 0
+
+        if size:
+            if len(self.rxbuf) < size + 2:
+                return None
+            if self.rxbuf[size:size + 2] == b'\r\n':
+                frame = bytes(self.rxbuf[:size])
+                del self.rxbuf[:size + 2]
+                return frame
+
+        i = self.rxbuf.find(b'\n')
+        if i < 0:
             return None
 
-    def recv_array(self):
-        ''' This command should not be used on its own: it is called by the execute commands
-            below in a thread safe manner.
+        line = self.rxbuf[:i].decode('ascii', 'replace').strip()
+        del self.rxbuf[:i + 1]
+
+        return line
+
+    def submit(self, cmds, size=0, check_ack=False):
+        ''' Queue a list of commands to be written to the Arduino in a single write
+            without waiting for the replies.  Returns one PendingReply per command,
+            in order.  A command that cannot be written gets a reply of None.
+            Commands should be bytes ending with '\\r'; str commands are encoded
+            and the '\\r' is added to any that lack it.
+            A non-zero size means each reply is a binary frame of that many bytes.
+            With check_ack, replies other than OK are counted in ack_errors.
         '''
-        try:
-            values = self.recv(self.timeout * self.N_ANALOG_PORTS).split()
-            return map(int, values)
-        except:
-            return []
+        replies = []
+        for cmd in cmds:
+            if not isinstance(cmd, bytes):
+                cmd = cmd.encode('ascii')
+            if not cmd.endswith(b'\r'):
+                cmd += b'\r'
+            replies.append(PendingReply(cmd, size, check_ack))
+
+        self.commands.put(replies)
+        return replies
+
+    def wait(self, reply, timeout):
+        ''' Wait for the reply to a submitted command.  Returns None on timeout,
+            leaving the command and any others in flight to be collected later.
+        '''
+        if reply.event.wait(timeout):
+            return reply.value
+        return None
 
-    def execute(self, cmd):
-        ''' Thread safe execution of "cmd" on the Arduino returning a single integer value.
+    def collect(self, reply, timeout):
+        ''' Wait for the reply to a submitted command, giving up on it and every
+            other outstanding command if it does not arrive in time.
+        '''
+        if reply.event.wait(timeout):
+            return reply.value
+
+        # A lost reply means the replies still to come can no longer be
+        # matched to their commands, so start over with an empty queue.
+        self.resync()
+        return None
+
+    def resync(self):
+        ''' Drop every outstanding command and any unread input from the Arduino,
+            and with them the receive buffer space they held.
         '''
         self.mutex.acquire()
+        try:
+            while True:
+                try:
+                    self.pending.popleft().event.set()
+                except IndexError:
+                    break
+            try:
+                self.port.flushInput()
+            except:
+                pass
+            self.rx_generation += 1
+        finally:
+            self.mutex.release()
 
+        self.in_flight_changed.acquire()
         try:
-            self.port.flushInput()
-        except:
-            pass
+            self.in_flight = 0
+            self.in_flight_changed.notify()
+        finally:
+            self.in_flight_changed.release()
+
+    def request(self, cmd, timeout):
+        ''' Send a single command and wait for its reply.
+        '''
+        return self.collect(self.submit([cmd])[0], timeout)
 
+    def execute(self, cmd):
+        ''' Thread safe execution of "cmd" on the Arduino returning a single integer value.
+        '''
         ntries = 1
         attempts = 0
 
         try:
-            self.port.write(cmd + '\r')
-            value = self.recv(self.timeout)
+            value = self.request(cmd, self.timeout)
             while attempts < ntries and (value == '' or value == 'Invalid Command' or value == None):
                 try:
-                    self.port.flushInput()
-                    self.port.write(cmd + '\r')
-                    value = self.recv(self.timeout)
+                    value = self.request(cmd, self.timeout)
                 except:
-                    print "Exception executing command: " + cmd
+                    print("Exception executing command:", cmd.strip())
                 attempts += 1
         except:
-            self.mutex.release()
-            print "Exception executing command: " + cmd
+            print("Exception executing command:", cmd.strip())
             value = None
 
-        self.mutex.release()
         return int(value)
 
     def execute_array(self, cmd):
         ''' Thread safe execution of "cmd" on the Arduino returning an array.
         '''
-        self.mutex.acquire()
+        values = self.request_values(cmd)
 
         try:
-            self.port.flushInput()
+            values = list(map(int, values.split()))
         except:
-            pass
+            values = []
+
+        return values
 
+    def execute_array_n(self, cmd, n):
+        ''' Thread safe execution of "cmd" on the Arduino for a reply of exactly n
+            space separated values.  Returns the values unconverted so the caller can
+            use the parser that suits the reply, or None if the reply has a different
+            number of values or is not a valid reply at all.
+        '''
+        values = self.request_values(cmd)
+
+        if values is None or values == 'Invalid Command':
+            return None
+
+        # Splitting at most n times still shows a reply with too many values
+        values = values.split(None, n)
+        if len(values) != n:
+            return None
+
+        return values
+
+    def request_values(self, cmd):
+        ''' Send "cmd" for a reply of space separated values, retrying once if it
+            gets no valid reply.  Returns the raw reply, or None if there was none.
+        '''
         ntries = 1
         attempts = 0
 
         try:
-            self.port.write(cmd + '\r')
-            values = self.recv_array()
-            while attempts < ntries and (values == '' or values == 'Invalid Command' or values == [] or values == None):
+            values = self.request(cmd, self.timeout * self.N_ANALOG_PORTS)
+            while attempts < ntries and (values == '' or values == 'Invalid Command' or values == None):
                 try:
-                    self.port.flushInput()
-                    self.port.write(cmd + '\r')
-                    values = self.recv_array()
+                    values = self.request(cmd, self.timeout * self.N_ANALOG_PORTS)
                 except:
-                    print("Exception executing command: " + cmd)
+                    print("Exception executing command:", cmd.strip())
                 attempts += 1
         except:
-            self.mutex.release()
-            print "Exception executing command: " + cmd
+            print("Exception executing command:", cmd.strip())
             raise SerialException
-            return []
-
-        try:
-            values = map(int, values)
-        except:
-            values = []
 
-        self.mutex.release()
         return values
 
     def execute_ack(self, cmd):
         ''' Thread safe execution of "cmd" on the Arduino returning True if response is ACK.
         '''
-        self.mutex.acquire()
-
-        try:
-            self.port.flushInput()
-        except:
-            pass
-
         ntries = 1
         attempts = 0
 
         try:
-            self.port.write(cmd + '\r')
-            ack = self.recv(self.timeout)
+            ack = self.request(cmd, self.timeout)
             while attempts < ntries and (ack == '' or ack == 'Invalid Command' or ack == None):
                 try:
-                    self.port.flushInput()
-                    self.port.write(cmd + '\r')
-                    ack = self.recv(self.timeout)
+                    ack = self.request(cmd, self.timeout)
                 except:
-                    print "Exception executing command: " + cmd
-            attempts += 1
+                    print("Exception executing command:", cmd.strip())
+                attempts += 1
         except:
-            self.mutex.release()
-            print "execute_ack exception when executing", cmd
-            print sys.exc_info()
+            print("execute_ack exception when executing", cmd.strip())
+            print(sys.exc_info())
             return 0
 
-        self.mutex.release()
         return ack == 'OK'
 
+    def execute_frame(self, cmd, size):
+        ''' Thread safe execution of "cmd" on the Arduino returning a binary reply of
+            "size" bytes.  Returns whatever else was received instead (such as
+            "Invalid Command") if the reply is not a valid frame, or None on timeout.
+        '''
+        try:
+            return self.collect(self.submit([cmd], size)[0], self.timeout)
+        except:
+            print("Exception executing command:", cmd.strip())
+            return None
+
+    def execute_async(self, cmd):
+        ''' Queue "cmd" for the Arduino and return without waiting for the reply.
+            Pass the returned PendingReply to wait() to collect the raw reply, so
+            several commands can be in flight at once.  Its done() method checks
+            for the reply without blocking:
+
+                sonar = arduino.execute_async(PING % 4)
+                ir = arduino.execute_async(ANALOG_READ % 1)
+                distance = int(arduino.wait(sonar, arduino.timeout))
+        '''
+        return self.submit([cmd])[0]
+
+    def execute_batch(self, cmds):
+        ''' Thread safe execution of a list of commands written to the Arduino in
+            a single write.  Returns the raw replies in order, with None for any
+            command that timed out.  Commands are not retried.
+        '''
+        replies = self.submit(cmds)
+        return [self.collect(reply, self.timeout) for reply in replies]
+
     def update_pid(self, Kp, Kd, Ki, Ko):
         ''' Set the PID parameters on the Arduino
         '''
-        print "Updating PID parameters"
-        cmd = 'u ' + str(Kp) + ':' + str(Kd) + ':' + str(Ki) + ':' + str(Ko)
-        self.execute_ack(cmd)
+        print("Updating PID parameters")
+        self.execute_ack(UPDATE_PID %(Kp, Kd, Ki, Ko))
 
     def get_baud(self):
         ''' Get the current baud rate on the serial port.
         '''
         try:
-            return int(self.execute('b'));
+            return int(self.execute(GET_BAUDRATE));
         except:
             return None
 
     def get_encoder_counts(self):
-        values = self.execute_array('e')
-        if len(values) != 2:
-            print "Encoder count was not 2"
+        values = self.execute_array_n(READ_ENCODERS, 2)
+        if values is None:
+            print("Encoder count was not 2")
             raise SerialException
             return None
         else:
+            try:
+                left, right = int(values[0]), int(values[1])
+            except ValueError:
+                print("Encoder counts were not integers")
+                raise SerialException
             if self.motors_reversed:
-                values[0], values[1] = -values[0], -values[1]
-            return values
+                return [-left, -right]
+            return [left, right]
+
+    def get_encoder_counts_binary(self):
+        ''' Read the encoder counts as a fixed size binary frame rather than as text.
+            The reply is no longer than the text one for large counts and needs
+            no splitting or int() conversion.  Requires firmware with the READ_ENCODERS_BIN command.
+        '''
+        frame = self.execute_frame(READ_ENCODERS_BIN, ENCODER_FRAME.size)
+        if not isinstance(frame, bytes) or len(frame) != ENCODER_FRAME.size:
+            print("Binary encoder frame was not received")
+            raise SerialException
+
+        marker, left, right, checksum = ENCODER_FRAME.unpack(frame)
+        check = 0
+        for byte in frame[1:-1]:
+            check ^= byte
+        if marker != ENCODER_FRAME_MARKER or checksum != check:
+            # Most likely a reply meant for another command, so the replies
+            # still to come cannot be trusted either
+            print("Binary encoder frame failed its check")
+            self.resync()
+            raise SerialException
+
+        if self.motors_reversed:
+            return [-left, -right]
+        return [left, right]
+
+    def poll_sensors(self, encoders=True, analog_pins=()):
+        ''' Read the encoder counts and any number of analog pins in a single
+            round trip using the firmware's POLL_SENSORS command.
+            Returns a tuple (encoder_counts, analog_values) where encoder_counts is
+            None unless requested and analog_values follows the order of analog_pins.
+        '''
+        pins = sorted(set(analog_pins))
+        mask = 0
+        for pin in pins:
+            mask |= 1 << pin
+
+        n_encoders = 2 if encoders else 0
+        if n_encoders + len(pins) == 0:
+            return None, []
+
+        values = self.execute_array_n(POLL_SENSORS %(mask, 1 if encoders else 0), n_encoders + len(pins))
+        if values is None:
+            print("Sensor poll did not return", n_encoders + len(pins), "values")
+            raise SerialException
+
+        try:
+            values = list(map(int, values))
+        except ValueError:
+            print("Sensor poll returned values that were not integers")
+            raise SerialException
+
+        counts = None
+        if encoders:
+            counts = values[:2]
+            if self.motors_reversed:
+                counts[0], counts[1] = -counts[0], -counts[1]
+
+        readings = dict(zip(pins, values[n_encoders:]))
+
+        return counts, [readings[pin] for pin in analog_pins]
 
     def reset_encoders(self):
         ''' Reset the encoder counts to 0
         '''
-        return self.execute_ack('r')
+        return self.execute_ack(RESET_ENCODERS)
 
     def drive(self, right, left):
         ''' Speeds are given in encoder ticks per PID interval
         '''
         if self.motors_reversed:
             left, right = -left, -right
-        return self.execute_ack('m %d %d' %(right, left))
 
-    def drive_m_per_s(self, right, left):
-        ''' Set the motor speeds in meters per second.
+        now = time.monotonic()
+        if self.drive_unchanged(right, left, now):
+            return True
+
+        ack = self.execute_ack(MOTOR_SPEEDS %(right, left))
+        if ack:
+            self.last_drive = (right, left)
+            self.last_drive_time = now
+            self.last_drive_errors = self.ack_errors
+        else:
+            self.last_drive = None
+
+        return ack
+
+    def drive_nowait(self, right, left):
+        ''' Like drive() but returns as soon as the command is queued instead of
+            waiting for the Arduino's OK.  A missing or bad OK is counted in
+            ack_errors by the reader thread.
+        '''
+        if self.motors_reversed:
+            left, right = -left, -right
+
+        now = time.monotonic()
+        if self.drive_unchanged(right, left, now):
+            return
+
+        self.submit([MOTOR_SPEEDS %(right, left)], check_ack=True)
+        self.last_drive = (right, left)
+        self.last_drive_time = now
+        self.last_drive_errors = self.ack_errors
+
+    def drive_unchanged(self, right, left, now):
+        ''' True if the speeds need not be sent because the same speeds, or speeds
+            within drive_deadband, were sent recently without an ack error since.
+        '''
+        if self.last_drive is None or now - self.last_drive_time >= self.drive_refresh:
+            return False
+        if self.ack_errors != self.last_drive_errors:
+            return False
+
+        last_right, last_left = self.last_drive
+        if (right, left) == self.last_drive:
+            return True
+        # Always send a stop
+        if right == 0 and left == 0:
+            return False
+        return abs(right - last_right) <= self.drive_deadband and abs(left - last_left) <= self.drive_deadband
+
+    def recompute_drive_constants(self):
+        ''' Precompute the conversion from meters per second to encoder ticks per
+            PID interval used by drive_m_per_s().  wheel_diameter, encoder_resolution
+            and gear_reduction are set by the caller; call this again after changing them.
+        '''
+        self.ticks_per_mps = self.encoder_resolution * self.PID_INTERVAL * self.gear_reduction / (self.wheel_diameter * PI)
+
+    def m_per_s_to_ticks(self, speeds):
+        ''' Convert a sequence of wheel speeds in meters per second to encoder ticks
+            per PID interval, for any number of wheels.
         '''
-        left_revs_per_second = float(left) / (self.wheel_diameter * PI)
-        right_revs_per_second = float(right) / (self.wheel_diameter * PI)
+        if self.ticks_per_mps is None:
+            self.recompute_drive_constants()
 
-        left_ticks_per_loop = int(left_revs_per_second * self.encoder_resolution * self.PID_INTERVAL * self.gear_reduction)
-        right_ticks_per_loop  = int(right_revs_per_second * self.encoder_resolution * self.PID_INTERVAL * self.gear_reduction)
+        k = self.ticks_per_mps
+        return [int(speed * k) for speed in speeds]
 
-        self.drive(right_ticks_per_loop , left_ticks_per_loop )
+    def drive_m_per_s(self, right, left):
+        ''' Set the motor speeds in meters per second.
+        '''
+        right_ticks, left_ticks = self.m_per_s_to_ticks((right, left))
+        self.drive(right_ticks, left_ticks)
 
     def stop(self):
         ''' Stop both motors.
         '''
+        self.last_drive = None
         self.drive(0, 0)
 
     def analog_read(self, pin):
-        return self.execute('a %d' %pin)
+        return self.execute(ANALOG_READ %pin)
 
     def analog_write(self, pin, value):
-        return self.execute_ack('x %d %d' %(pin, value))
+        return self.execute_ack(ANALOG_WRITE %(pin, value))
 
     def digital_read(self, pin):
-        return self.execute('d %d' %pin)
+        return self.execute(DIGITAL_READ %pin)
 
     def digital_write(self, pin, value):
-        return self.execute_ack('w %d %d' %(pin, value))
+        return self.execute_ack(DIGITAL_WRITE %(pin, value))
 
     def pin_mode(self, pin, mode):
-        return self.execute_ack('c %d %d' %(pin, mode))
+        return self.execute_ack(PIN_MODE %(pin, mode))
 
     def servo_write(self, id, pos):
         ''' Usage: servo_write(id, pos)
             Position is given in radians and converted to degrees before sending
         '''
-        return self.execute_ack('s %d %d' %(id, min(SERVO_MAX, max(SERVO_MIN, degrees(pos)))))
+        return self.execute_ack(SERVO_WRITE %(id, min(SERVO_MAX, max(SERVO_MIN, degrees(pos)))))
 
     def servo_read(self, id):
         ''' Usage: servo_read(id)
             The returned position is converted from degrees to radians
         '''
-        return radians(self.execute('t %d' %id))
+        return radians(self.execute(SERVO_READ %id))
 
     def ping(self, pin):
         ''' The srf05/Ping command queries an SRF05/Ping sonar sensor
             connected to the General Purpose I/O line pinId for a distance,
             and returns the range in cm.  Sonar distance resolution is integer based.
         '''
-        return self.execute('p %d' %pin);
+        return self.execute(PING %pin);
 
 #    def get_maxez1(self, triggerPin, outputPin):
 #        ''' The maxez1 command queries a Maxbotix MaxSonar-EZ1 sonar
@@ -359,22 +918,28 @@ if __name__ == "__main__":
     baudRate = 57600
 
     myArduino = Arduino(port=portName, baudrate=baudRate, timeout=0.5)
-    myArduino.connect()
-
-    print "Sleeping for 1 second..."
+    try:
+        myArduino.connect()
+    except SerialException:
+        if myArduino.is_open():
+            myArduino.stop()
+        myArduino.close()
+        sys.exit(1)
+
+    print("Sleeping for 1 second...")
     time.sleep(1)
 
-    print "Reading on analog port 0", myArduino.analog_read(0)
-    print "Reading on digital port 0", myArduino.digital_read(0)
-    print "Blinking the LED 3 times"
+    print("Reading on analog port 0", myArduino.analog_read(0))
+    print("Reading on digital port 0", myArduino.digital_read(0))
+    print("Blinking the LED 3 times")
     for i in range(3):
         myArduino.digital_write(13, 1)
         time.sleep(1.0)
     #print "Current encoder counts", myArduino.encoders()
 
-    print "Connection test successful.",
+    print("Connection test successful.", end=' ')
 
     myArduino.stop()
     myArduino.close()
 
-    print "Shutting down Arduino."
+    print("Shutting down Arduino.")
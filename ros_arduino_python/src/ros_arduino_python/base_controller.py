@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """
     A base controller class for the Arduino microcontroller
@@ -51,6 +51,7 @@ class BaseController:
         
         self.accel_limit = rospy.get_param('~accel_limit', 0.1)
         self.motors_reversed = rospy.get_param("~motors_reversed", False)
+        self.binary_encoders = rospy.get_param("~binary_encoders", False)
         
         # Set up PID parameters and check for missing values
         self.setup_pid(pid_params)
@@ -122,7 +123,10 @@ class BaseController:
         if now > self.t_next:
             # Read the encoders
             try:
-                left_enc, right_enc = self.arduino.get_encoder_counts()
+                if self.binary_encoders:
+                    left_enc, right_enc = self.arduino.get_encoder_counts_binary()
+                else:
+                    left_enc, right_enc = self.arduino.get_encoder_counts()
             except:
                 self.bad_encoder_count += 1
                 rospy.logerr("Encoder exception count: " + str(self.bad_encoder_count))
@@ -210,7 +214,7 @@ class BaseController:
             
             # Set motor speeds in encoder ticks per PID loop
             if not self.stopped:
-                self.arduino.drive(self.v_left, self.v_right)
+                self.arduino.drive_nowait(self.v_left, self.v_right)
                 
             self.t_next = now + self.t_delta
             